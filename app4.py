@@ -12,6 +12,8 @@ import json
 import numpy as np
 import faiss
 import time
+from tracing import Tracer, MetricsRegistry, JsonlSink, SamplingProfiler, start_metrics_server, NULL_TRACE
+from chat_store import ChatStore
 
 load_dotenv()
 
@@ -43,6 +45,77 @@ def check_api_keys():
     
     return openrouter_key is not None and jina_key is not None
 
+# --- Tracing & Metrics ---
+# TRACE_JSONL_PATH: file to append one JSON trace per request (disabled if empty)
+# METRICS_PORT: local port for the Prometheus-style /metrics endpoint (disabled if empty)
+@st.cache_resource
+def get_tracer():
+    sinks = []
+    trace_path = get_env_var("TRACE_JSONL_PATH")
+    if trace_path:
+        sinks.append(JsonlSink(trace_path))
+    tracer = Tracer(MetricsRegistry(), sinks)
+    metrics_port = get_env_var("METRICS_PORT")
+    if metrics_port:
+        try:
+            start_metrics_server(tracer.registry, int(metrics_port))
+        except (OSError, ValueError) as e:
+            print(f"Metrics server not started: {e}")
+    return tracer
+
+# Sampling profiler is shared by all sessions; the sidebar toggle is only shown when ENABLE_PROFILER is set
+@st.cache_resource
+def get_profiler():
+    return SamplingProfiler()
+
+tracer = get_tracer()
+profiler = get_profiler()
+profiler_enabled = str(get_env_var("ENABLE_PROFILER", "")).lower() in ("1", "true", "yes")
+
+# --- Penyimpanan Riwayat Chat ---
+# CHAT_DB_PATH: SQLite file for persisted chat sessions
+# CHAT_MEMORY_TURNS: recent turns per session kept in memory, sent to the LLM and rendered by default
+# CHAT_RETENTION_DAYS: turns older than this are purged (0 keeps everything)
+# CHAT_IDLE_MINUTES: idle sessions are dropped from memory (still resumable from disk)
+def get_number_setting(key, default, cast=int):
+    """Read a numeric setting, falling back to the default on invalid values."""
+    value = get_env_var(key, default)
+    try:
+        return cast(value)
+    except (TypeError, ValueError) as e:
+        print(f"Invalid {key}={value!r}, using {default}: {e}")
+        return default
+
+@st.cache_resource
+def get_chat_store():
+    return ChatStore(
+        get_env_var("CHAT_DB_PATH", "data/chat_history.sqlite3"),
+        memory_turns=get_number_setting("CHAT_MEMORY_TURNS", 20),
+        retention_days=get_number_setting("CHAT_RETENTION_DAYS", 30, float),
+        idle_timeout=get_number_setting("CHAT_IDLE_MINUTES", 30, float) * 60,
+    )
+
+chat_store = get_chat_store()
+
+def is_valid_session_id(session_id):
+    """Session IDs are uuid4().hex values: 32 lowercase hex characters."""
+    return isinstance(session_id, str) and len(session_id) == 32 and all(c in "0123456789abcdef" for c in session_id)
+
+def get_session_id():
+    """Session ID is kept in the URL (?sid=...) so a reconnect resumes the same conversation."""
+    if "session_id" not in st.session_state:
+        session_id = st.query_params.get("sid")
+        st.session_state.session_id = session_id if is_valid_session_id(session_id) else uuid.uuid4().hex
+    if st.query_params.get("sid") != st.session_state.session_id:
+        st.query_params["sid"] = st.session_state.session_id
+    return st.session_state.session_id
+
+def format_perf_footer(meta):
+    """Render stored timing info as the footer shown under an answer."""
+    if not meta or "total_time" not in meta:
+        return ""
+    return f"\n\n---\n⚡ **Waktu**: {meta['total_time']:.2f}s (Pencarian: {meta['search_time']:.2f}s, LLM: {meta['llm_time']:.2f}s)"
+
 # Load FAISS index (wajib ada sebelum aplikasi dijalankan)
 faiss_index_path = "extracted/faiss_index"
 faiss_metadata_path = "extracted/faiss_metadata.json"  
@@ -106,15 +179,20 @@ if "temp_vectorstore" not in st.session_state:
 if "embedding_cache" not in st.session_state:
     st.session_state.embedding_cache = {}
 
-def get_cached_embedding(text, api_key, cache_key=None):
+def get_cached_embedding(text, api_key, cache_key=None, trace=NULL_TRACE):
     """Get embedding with caching to reduce API calls."""
     if cache_key is None:
         cache_key = text[:100]  # Use first 100 chars as cache key
     
-    if cache_key in st.session_state.embedding_cache:
-        return st.session_state.embedding_cache[cache_key]
+    with trace.span("cache_lookup") as span:
+        cached = st.session_state.embedding_cache.get(cache_key)
+        span.set(cache_hit=cached is not None, cache_size=len(st.session_state.embedding_cache))
+    if cached is not None:
+        return cached
     
-    embedding = get_jina_embedding(text, api_key)
+    with trace.span("embed", texts=1) as span:
+        embedding = get_jina_embedding(text, api_key)
+        span.set(ok=embedding is not None)
     if embedding:
         st.session_state.embedding_cache[cache_key] = embedding
         # Limit cache size to prevent memory issues
@@ -132,6 +210,7 @@ llm = ChatOpenAI(
     model_name=get_env_var("DEFAULT_MODEL", "deepseek/deepseek-chat"),
     temperature=0.1,
     streaming=True,  # Enable streaming for better user experience
+    stream_usage=True,  # Report real token usage on the final stream chunk (for tracing)
 )
 
 # Build retriever using FAISS index
@@ -182,7 +261,7 @@ def search_similar_chunks_batch(queries, api_key, k=50):
     
     return batch_results
 
-def search_similar_chunks(query, api_key, k=50):
+def search_similar_chunks(query, api_key, k=50, trace=NULL_TRACE):
     """Search for similar chunks using FAISS and return actual text content."""
     faiss_index, chunks_data, metadata = build_combined_retriever()
     
@@ -190,25 +269,28 @@ def search_similar_chunks(query, api_key, k=50):
         return []
     
     # Get query embedding with caching
-    query_embedding = get_cached_embedding(query, api_key)
+    query_embedding = get_cached_embedding(query, api_key, trace=trace)
     if query_embedding is None:
         return []
     
     # Convert to numpy array and search
-    query_embedding_np = np.array(query_embedding, dtype='float32').reshape(1, -1)
-    distances, indices = faiss_index.search(query_embedding_np, k=k)
+    with trace.span("faiss_search", k=k, ntotal=faiss_index.ntotal):
+        query_embedding_np = np.array(query_embedding, dtype='float32').reshape(1, -1)
+        distances, indices = faiss_index.search(query_embedding_np, k=k)
     
     # Retrieve actual text content
-    results = []
-    for i, idx in enumerate(indices[0]):
-        if idx < len(chunks_data):
-            chunk_text = chunks_data[idx]["chunk"]
-            results.append({
-                "text": chunk_text,
-                "score": distances[0][i],
-                "filename": chunks_data[idx]["filename"],
-                "chunk_index": chunks_data[idx]["chunk_index"]
-            })
+    with trace.span("chunk_hydration") as span:
+        results = []
+        for i, idx in enumerate(indices[0]):
+            if idx < len(chunks_data):
+                chunk_text = chunks_data[idx]["chunk"]
+                results.append({
+                    "text": chunk_text,
+                    "score": distances[0][i],
+                    "filename": chunks_data[idx]["filename"],
+                    "chunk_index": chunks_data[idx]["chunk_index"]
+                })
+        span.set(hits=len(results))
     
     return results
 
@@ -296,51 +378,87 @@ with st.sidebar.expander("🔧 Debug Info"):
     if st.button("Check API Keys"):
         check_api_keys()
 
+    # Mulai sesi chat baru (sesi lama tetap tersimpan sampai masa retensi habis)
+    if st.button("Percakapan Baru"):
+        st.session_state.session_id = uuid.uuid4().hex
+        st.session_state.visible_turns = chat_store.memory_turns
+
+    # Sampling profiler can be switched on/off at runtime (operators only)
+    if profiler_enabled:
+        if profiler.running:
+            if st.button("Stop Profiler"):
+                profiler.stop()
+        elif st.button(f"Start Profiler (maks. {profiler.max_duration}s)"):
+            profiler.start()
+        if profiler.total_samples:
+            st.caption(f"{profiler.total_samples} samples")
+            for stack, count in profiler.top(5):
+                st.text(f"{count:>5}  {stack}")
+            if st.button("Reset Profiler"):
+                profiler.reset()
+
 # ----------------------------
 # PAGE 1: Chatbot Layanan Publik
 # ----------------------------
 if page == "Chatbot Layanan":
     st.title("🤖 Chatbot Layanan Kota Cimahi")
-    if "chat_history" not in st.session_state:
-        st.session_state.chat_history = []
-
-    user_question = st.chat_input("Ajukan pertanyaan...")    # Tampilkan riwayat chat (termasuk chat user terbaru jika ada)
-    for msg in st.session_state.chat_history:
+    session_id = get_session_id()
+    if "visible_turns" not in st.session_state:
+        st.session_state.visible_turns = chat_store.memory_turns
+
+    user_question = st.chat_input("Ajukan pertanyaan...")
+    # Tampilkan riwayat chat: hanya jendela pesan terbaru, pesan lama dimuat sesuai permintaan
+    total_turns = chat_store.count(session_id)
+    if total_turns > st.session_state.visible_turns:
+        if st.button(f"⬆️ Tampilkan pesan sebelumnya ({total_turns - st.session_state.visible_turns})"):
+            st.session_state.visible_turns += chat_store.memory_turns
+    if st.session_state.visible_turns > chat_store.memory_turns:
+        visible_history = chat_store.history(session_id, limit=st.session_state.visible_turns)
+    else:
+        visible_history = chat_store.recent(session_id, st.session_state.visible_turns)
+    for msg in visible_history:
         with st.chat_message(msg["role"], avatar="👤" if msg["role"] == "user" else "🤖"):
-            st.markdown(msg["content"])
-      # Jika user baru saja mengirim pertanyaan, tampilkan langsung di UI
+            st.markdown(msg["content"] + format_perf_footer(msg["meta"]))
+    # Jika user baru saja mengirim pertanyaan, tampilkan langsung di UI
     if user_question:
-        st.session_state.chat_history.append({"role": "user", "content": user_question})
-        with st.chat_message("user", avatar="👤"):
-            st.markdown(user_question)
-
-        # Check if FAISS files are available
-        if not has_faiss_files:
-            # Fallback response when FAISS is not available
-            answer = "Maaf, sistem pencarian dokumen sedang tidak tersedia. Namun saya dapat membantu dengan informasi umum tentang layanan Kota Cimahi. Untuk informasi lebih detail, silakan hubungi kantor pelayanan terkait."
-            with st.chat_message("assistant", avatar="🤖"):
-                            st.markdown(answer)
-        else:
-            # Normal processing with FAISS
-            # Start performance monitoring
-            start_time = time.time()
-            answer = ""  # Initialize answer variable
-            with st.spinner("🔍 Mencari informasi yang relevan..."):
-                api_key = get_env_var("JINA_API_KEY")
-                search_start = time.time()
-                results = search_similar_chunks(user_question, api_key, k=50)
-                search_time = time.time() - search_start
-
-                if results:
-                    # Create shorter context for faster processing
-                    context = "\n\n".join([result["text"][:800] for result in results[:3]])
-                      # Show retrieved sources
-                    with st.expander("📚 Sumber Informasi"):
-                        st.info(f"⚡ Pencarian: {search_time:.2f}s | Dokumen: {len(results)}")
-                        for i, result in enumerate(results[:3], 1):  # Fixed: showing only top 3
-                            st.write(f"**{i}. {result['filename']}**")
-                            st.write(f"_{result['text'][:150]}..._")                    # Optimized system message for better response reliability
-                    system_prompt = """Kamu adalah chatbot berbasis RAG bernama "CIMAS", dibuat untuk memberikan pelayanan informasi kepada masyarakat Kota Cimahi terkait layanan pemerintahan. Tugasmu adalah memberikan jawaban yang akurat, jelas, ramah, dan sesuai dengan dokumen resmi Pemerintah Kota Cimahi di database.
+        # Riwayat untuk LLM diambil dari jendela memori sebelum pertanyaan baru disimpan
+        prior_turns = chat_store.recent(session_id)
+        chat_store.append(session_id, "user", user_question)
+        answer = ""
+        answer_meta = {}
+        try:
+            with st.chat_message("user", avatar="👤"):
+                st.markdown(user_question)
+
+            # Check if FAISS files are available
+            if not has_faiss_files:
+                # Fallback response when FAISS is not available
+                answer = "Maaf, sistem pencarian dokumen sedang tidak tersedia. Namun saya dapat membantu dengan informasi umum tentang layanan Kota Cimahi. Untuk informasi lebih detail, silakan hubungi kantor pelayanan terkait."
+                with st.chat_message("assistant", avatar="🤖"):
+                                st.markdown(answer)
+            else:
+                # Normal processing with FAISS
+                # Start performance monitoring
+                trace = tracer.start_trace("chat_request", history_turns=len(prior_turns))
+                answer = ""  # Initialize answer variable
+                try:
+                    with st.spinner("🔍 Mencari informasi yang relevan..."):
+                        api_key = get_env_var("JINA_API_KEY")
+                        with trace.span("retrieval", k=50) as span:
+                            results = search_similar_chunks(user_question, api_key, k=50, trace=trace)
+                            span.set(hits=len(results))
+                        search_time = trace.duration_of("retrieval")
+
+                        if results:
+                            # Create shorter context for faster processing
+                            context = "\n\n".join([result["text"][:800] for result in results[:3]])
+                              # Show retrieved sources
+                            with st.expander("📚 Sumber Informasi"):
+                                st.info(f"⚡ Pencarian: {search_time:.2f}s | Dokumen: {len(results)}")
+                                for i, result in enumerate(results[:3], 1):  # Fixed: showing only top 3
+                                    st.write(f"**{i}. {result['filename']}**")
+                                    st.write(f"_{result['text'][:150]}..._")                    # Optimized system message for better response reliability
+                            system_prompt = """Kamu adalah chatbot berbasis RAG bernama "CIMAS", dibuat untuk memberikan pelayanan informasi kepada masyarakat Kota Cimahi terkait layanan pemerintahan. Tugasmu adalah memberikan jawaban yang akurat, jelas, ramah, dan sesuai dengan dokumen resmi Pemerintah Kota Cimahi di database.
 Aturan utama:
 Selalu gunakan informasi dari dokumen resmi di database untuk menjawab pertanyaan.Jawab dalam bahasa Indonesia yang formal namun ramah, sesuai konteks pelayanan publik.
 Jika informasi tidak tersedia, katakan dengan sopan bahwa kamu tidak memiliki data tersebut dan sarankan pengguna menghubungi instansi terkait.
@@ -361,87 +479,108 @@ Prioritaskan informasi terkini dan sesuai regulasi terbaru.
 Untuk pertanyaan sensitif (keluhan/kritik), arahkan ke kanal resmi seperti pengaduan masyarakat.
 
 Mulai setiap interaksi dengan sapaan ramah, misalnya: "Halo, selamat datang di CIMAS! Bagaimana saya bisa membantu Anda hari ini?"""
-                    messages = [SystemMessage(content=system_prompt)]
-
-                    # Add previous chat history to messages
-                    for msg in st.session_state.chat_history[:-1]:  # Exclude current question
-                        if msg["role"] == "user":
-                            messages.append(HumanMessage(content=msg["content"]))
-                        elif msg["role"] == "assistant":
-                            # Clean up assistant response from performance info
-                            cleaned_content = msg["content"].split("\n\n---")[0]
-                            messages.append(AIMessage(content=cleaned_content))
+                            with trace.span("prompt_build", context_chunks=len(results[:3])) as span:
+                                messages = [SystemMessage(content=system_prompt)]
+
+                                # Add previous chat history to messages
+                                for msg in prior_turns:
+                                    if msg["role"] == "user":
+                                        messages.append(HumanMessage(content=msg["content"]))
+                                    elif msg["role"] == "assistant":
+                                        messages.append(AIMessage(content=msg["content"]))
                     
-                    messages.extend([
-                        SystemMessage(content=f"KONTEKS DOKUMEN:\n{context}"),
-                        HumanMessage(content=f"Pertanyaan: {user_question}")
-                    ])
-                      # Initialize response container
-                    with st.chat_message("assistant", avatar="🤖"):
-                        llm_start = time.time()
-                        response_placeholder = st.empty()
-                        full_response = ""
-                        
-                        try:
-                            # Check API key before making LLM call
-                            openrouter_key = get_env_var("OPENROUTER_API_KEY")
-                            if not openrouter_key:
-                                st.error("❌ OpenRouter API key tidak ditemukan! Silakan periksa konfigurasi API key.")
-                                # Provide detailed response from context without LLM
-                                full_response = f"**Berdasarkan dokumen yang tersedia mengenai '{user_question}':**\n\n{context}\n\n**Catatan:** Respon ini dibuat berdasarkan pencarian dokumen tanpa pemrosesan AI karena masalah konfigurasi API."                             
-                            else:# Use streaming for better user experience
+                                messages.extend([
+                                    SystemMessage(content=f"KONTEKS DOKUMEN:\n{context}"),
+                                    HumanMessage(content=f"Pertanyaan: {user_question}")
+                                ])
+                                # Rough estimate (~4 chars per token); the real count comes from the LLM usage report
+                                span.set(messages=len(messages), prompt_tokens_estimate=sum(len(m.content) for m in messages) // 4)
+                              # Initialize response container
+                            with st.chat_message("assistant", avatar="🤖"):
+                                response_placeholder = st.empty()
                                 full_response = ""
+                        
+                                try:
+                                    # Check API key before making LLM call
+                                    openrouter_key = get_env_var("OPENROUTER_API_KEY")
+                                    if not openrouter_key:
+                                        st.error("❌ OpenRouter API key tidak ditemukan! Silakan periksa konfigurasi API key.")
+                                        # Provide detailed response from context without LLM
+                                        full_response = f"**Berdasarkan dokumen yang tersedia mengenai '{user_question}':**\n\n{context}\n\n**Catatan:** Respon ini dibuat berdasarkan pencarian dokumen tanpa pemrosesan AI karena masalah konfigurasi API."                             
+                                    else:# Use streaming for better user experience
+                                        full_response = ""
                                 
-                                # Stream the response with character limit
-                                for chunk in llm.stream(messages):
-                                    if hasattr(chunk, 'content') and chunk.content:
-                                        # Stream full response without character limit
-                                        full_response += chunk.content
-                                        # Update display in real-time with cursor
-                                        response_placeholder.markdown(full_response + "")
-                                        time.sleep(0.02)  # Slow down streaming (adjust delay as needed)
+                                        # Stream the response with character limit
+                                        with trace.span("llm_stream", model=llm.model_name) as span:
+                                            llm_start = time.perf_counter()
+                                            stream_chunks = 0
+                                            for chunk in llm.stream(messages):
+                                                usage = getattr(chunk, "usage_metadata", None)
+                                                if usage:
+                                                    span.set(prompt_tokens=usage.get("input_tokens"), completion_tokens=usage.get("output_tokens"))
+                                                    trace.set(prompt_tokens=usage.get("input_tokens"))
+                                                if hasattr(chunk, 'content') and chunk.content:
+                                                    if stream_chunks == 0:
+                                                        # Time to first token, measured from stream start and request start
+                                                        span.set(ttft=time.perf_counter() - llm_start)
+                                                        trace.mark("llm_first_token")
+                                                    stream_chunks += 1
+                                                    # Stream full response without character limit
+                                                    full_response += chunk.content
+                                                    # Update display in real-time with cursor
+                                                    response_placeholder.markdown(full_response + "")
+                                                    time.sleep(0.02)  # Slow down streaming (adjust delay as needed)
+                                            span.set(chunks=stream_chunks, response_chars=len(full_response))
                                 
 
-                            llm_time = time.time() - llm_start
-                            total_time = time.time() - start_time
+                                    llm_time = trace.duration_of("llm_stream")
+                                    total_time = trace.elapsed
                             
-                            # Add performance info
-                            perf_info = f"\n\n---\n⚡ **Waktu**: {total_time:.2f}s (Pencarian: {search_time:.2f}s, LLM: {llm_time:.2f}s)"
-                            final_response = full_response + perf_info
+                                    # Add performance info (stored as metadata, not in the answer text)
+                                    answer_meta = {
+                                        "total_time": round(total_time, 3),
+                                        "search_time": round(search_time, 3),
+                                        "llm_time": round(llm_time, 3),
+                                        "trace_id": trace.trace_id,
+                                    }
                             
-                            # Show final response without cursor
-                            response_placeholder.markdown(final_response)
-                            answer = final_response  # Store the complete answer
+                                    # Show final response without cursor
+                                    response_placeholder.markdown(full_response + format_perf_footer(answer_meta))
+                                    answer = full_response  # Store the complete answer
                         
-                        except Exception as e:
-                            llm_time = time.time() - llm_start
-                            error_str = str(e)
+                                except Exception as e:
+                                    error_str = str(e)
                             
-                            # Handle specific API authentication errors
-                            if "401" in error_str or "auth" in error_str.lower():
-                                st.error("❌ **Masalah Autentikasi API**: Silakan periksa API key di sidebar > Debug Info")
-                                # Provide a comprehensive response based on context
-                                fallback_response = f"""**Berdasarkan informasi yang tersedia:**
+                                    # Handle specific API authentication errors
+                                    if "401" in error_str or "auth" in error_str.lower():
+                                        st.error("❌ **Masalah Autentikasi API**: Silakan periksa API key di sidebar > Debug Info")
+                                        # Provide a comprehensive response based on context
+                                        fallback_response = f"""**Berdasarkan informasi yang tersedia:**
 
 {context}
 
 **Catatan:** Respon ini dibuat berdasarkan pencarian dokumen. Untuk informasi lengkap, silakan hubungi kantor pelayanan terkait."""
-                                response_placeholder.markdown(fallback_response)
-                                answer = fallback_response
-                            else:
-                                st.error(f"Error saat mengambil respons LLM: {error_str}")
-                                # Provide fallback response based on context
-                                error_msg = f"Terjadi kesalahan saat memproses permintaan. Namun berdasarkan informasi yang tersedia:\n\n{context[:600]}...\n\nSilakan coba lagi atau hubungi layanan terkait untuk informasi lebih detail."
-                                response_placeholder.markdown(error_msg)
-                                answer = error_msg
+                                        response_placeholder.markdown(fallback_response)
+                                        answer = fallback_response
+                                    else:
+                                        st.error(f"Error saat mengambil respons LLM: {error_str}")
+                                        # Provide fallback response based on context
+                                        error_msg = f"Terjadi kesalahan saat memproses permintaan. Namun berdasarkan informasi yang tersedia:\n\n{context[:600]}...\n\nSilakan coba lagi atau hubungi layanan terkait untuk informasi lebih detail."
+                                        response_placeholder.markdown(error_msg)
+                                        answer = error_msg
                         
-                else:
-                    answer = "Maaf, tidak menemukan informasi relevan dalam dokumen."
-                    with st.chat_message("assistant", avatar="🤖"):
-                        st.markdown(answer)
-
-        # Store the answer in chat history AFTER it's been generated
-        st.session_state.chat_history.append({"role": "assistant", "content": answer})
+                        else:
+                            answer = "Maaf, tidak menemukan informasi relevan dalam dokumen."
+                            with st.chat_message("assistant", avatar="🤖"):
+                                st.markdown(answer)
+                finally:
+                    trace.finish()
+        finally:
+            # Always store an answer for the stored question, so history keeps alternating user/assistant turns
+            if not answer:
+                answer = "_(Jawaban terputus. Silakan ajukan pertanyaan kembali.)_"
+                answer_meta = {**answer_meta, "interrupted": True}
+            chat_store.append(session_id, "assistant", answer, answer_meta)
 
 # ----------------------------
 # PAGE 2: Pengaduan Masyarakat
@@ -0,0 +1,138 @@
+# chat_store.py
+"""
+Durable, bounded conversation store for the chatbot page.
+
+Every turn is persisted to a local SQLite database keyed by session ID, so a
+session can be resumed after a reconnect. Only a small window of recent turns
+per session is kept in memory; sessions that stay idle are dropped from memory
+(not from disk) and turns older than the retention period are purged.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+
+class ChatStore:
+    """SQLite-backed chat history with an in-memory window of recent turns."""
+
+    def __init__(self, db_path, memory_turns=20, retention_days=30, idle_timeout=1800, sweep_interval=600):
+        self.db_path = db_path
+        self.memory_turns = max(1, memory_turns)
+        self.retention_days = max(0, retention_days)
+        self.idle_timeout = max(0, idle_timeout)
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._windows = {}  # session_id -> deque of recent turns
+        self._last_access = {}  # session_id -> monotonic time of last use
+        self._last_sweep = time.monotonic()
+
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS chat_turns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                meta TEXT,
+                created_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_turns_session ON chat_turns (session_id, id)")
+        self._conn.commit()
+
+    @staticmethod
+    def _row_to_turn(row):
+        turn_id, role, content, meta, created_at = row
+        return {
+            "id": turn_id,
+            "role": role,
+            "content": content,
+            "meta": json.loads(meta) if meta else {},
+            "created_at": created_at,
+        }
+
+    def _load_window(self, session_id):
+        """Return the in-memory window for a session, loading it from disk if needed."""
+        window = self._windows.get(session_id)
+        if window is None:
+            rows = self._conn.execute(
+                "SELECT id, role, content, meta, created_at FROM chat_turns "
+                "WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                (session_id, self.memory_turns),
+            ).fetchall()
+            window = deque((self._row_to_turn(r) for r in reversed(rows)), maxlen=self.memory_turns)
+            self._windows[session_id] = window
+        self._last_access[session_id] = time.monotonic()
+        return window
+
+    def append(self, session_id, role, content, meta=None):
+        """Persist a turn and add it to the session's in-memory window."""
+        created_at = time.time()
+        with self._lock:
+            window = self._load_window(session_id)
+            cursor = self._conn.execute(
+                "INSERT INTO chat_turns (session_id, role, content, meta, created_at) VALUES (?, ?, ?, ?, ?)",
+                (session_id, role, content, json.dumps(meta, ensure_ascii=False) if meta else None, created_at),
+            )
+            self._conn.commit()
+            turn = {"id": cursor.lastrowid, "role": role, "content": content, "meta": meta or {}, "created_at": created_at}
+            window.append(turn)
+            self._maybe_sweep()
+        return turn
+
+    def recent(self, session_id, limit=None):
+        """Return up to `limit` most recent turns (oldest first) from the in-memory window."""
+        with self._lock:
+            turns = list(self._load_window(session_id))
+            self._maybe_sweep()
+        if limit is not None:
+            turns = turns[-limit:] if limit > 0 else []
+        return turns
+
+    def history(self, session_id, limit):
+        """Return up to `limit` most recent turns (oldest first) from disk, for showing more than the in-memory window."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, role, content, meta, created_at FROM chat_turns "
+                "WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                (session_id, limit),
+            ).fetchall()
+        return [self._row_to_turn(r) for r in reversed(rows)]
+
+    def count(self, session_id):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM chat_turns WHERE session_id = ?", (session_id,)
+            ).fetchone()[0]
+
+    def _maybe_sweep(self):
+        """Evict idle sessions from memory and purge expired turns (caller holds the lock)."""
+        now = time.monotonic()
+        if now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+
+        idle = [sid for sid, last in self._last_access.items() if now - last > self.idle_timeout]
+        for sid in idle:
+            self._windows.pop(sid, None)
+            self._last_access.pop(sid, None)
+
+        if self.retention_days:
+            cutoff = time.time() - self.retention_days * 86400
+            self._conn.execute("DELETE FROM chat_turns WHERE created_at < ?", (cutoff,))
+            self._conn.commit()
+            # Keep cached windows in line with disk (turns are stored oldest first)
+            for sid, window in list(self._windows.items()):
+                while window and window[0]["created_at"] < cutoff:
+                    window.popleft()
+                if not window:
+                    self._windows.pop(sid, None)
+                    self._last_access.pop(sid, None)
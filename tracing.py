@@ -0,0 +1,358 @@
+# tracing.py
+"""
+Lightweight per-request tracing and metrics export for the RAG pipeline.
+
+Spans are timed with time.perf_counter and aggregated into Prometheus-style
+histograms (served on a local /metrics endpoint) and/or appended as one JSON
+line per request to a JSONL sink. A sampling profiler can be switched on and
+off at runtime to see where wall time goes inside a slow span.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram buckets in seconds (covers fast cache hits up to slow LLM streams)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Span:
+    """A single timed step inside a request trace."""
+
+    def __init__(self, name, start, attributes=None):
+        self.name = name
+        self.start = start
+        self.end = None
+        self.attributes = dict(attributes or {})
+
+    @property
+    def duration(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self, origin):
+        return {
+            "name": self.name,
+            "offset": round(self.start - origin, 6),
+            "duration": round(self.duration, 6) if self.duration is not None else None,
+            "attributes": self.attributes,
+        }
+
+
+class Trace:
+    """Collects the spans of one chatbot request."""
+
+    def __init__(self, tracer, name, attributes=None):
+        self.tracer = tracer
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        self.end = None
+        self.attributes = dict(attributes or {})
+        self.spans = []
+        self.events = {}
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Time a block of code; yields the Span so attributes can be added."""
+        current = Span(name, time.perf_counter(), attributes)
+        self.spans.append(current)
+        try:
+            yield current
+        except Exception as e:
+            current.set(error=type(e).__name__)
+            raise
+        except BaseException:
+            # Script stop/rerun (e.g. user interaction mid-stream) or interrupt
+            current.set(aborted=True)
+            self.set(aborted=True)
+            raise
+        finally:
+            current.end = time.perf_counter()
+
+    def mark(self, name):
+        """Record a point-in-time event (e.g. first LLM token) relative to trace start."""
+        self.events[name] = time.perf_counter() - self.start
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def duration_of(self, name):
+        """Total duration of all finished spans with the given name."""
+        return sum(s.duration for s in self.spans if s.name == name and s.duration is not None)
+
+    @property
+    def elapsed(self):
+        end = self.end if self.end is not None else time.perf_counter()
+        return end - self.start
+
+    def finish(self):
+        if self.end is None:
+            self.end = time.perf_counter()
+            self.tracer.record(self)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "timestamp": self.timestamp,
+            "duration": round(self.elapsed, 6),
+            "attributes": self.attributes,
+            "events": {k: round(v, 6) for k, v in self.events.items()},
+            "spans": [s.to_dict(self.start) for s in self.spans],
+        }
+
+
+class _NullSpan:
+    def set(self, **attributes):
+        pass
+
+
+class NullTrace:
+    """Drop-in Trace replacement used when no trace is passed in."""
+
+    @contextmanager
+    def span(self, name, **attributes):
+        yield _NullSpan()
+
+    def mark(self, name):
+        pass
+
+    def set(self, **attributes):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class Histogram:
+    """Cumulative Prometheus-style histogram."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.total += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class MetricsRegistry:
+    """Aggregates finished traces into histograms and counters."""
+
+    def __init__(self, prefix="cimas", buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._span_hist = {}
+        self._event_hist = {}
+        self._request_hist = Histogram(buckets)
+        self._counters = Counter()
+
+    def observe_trace(self, trace):
+        with self._lock:
+            self._request_hist.observe(trace.elapsed)
+            self._counters["requests_total"] += 1
+            for s in trace.spans:
+                if s.duration is None:
+                    continue
+                self._span_hist.setdefault(s.name, Histogram(self.buckets)).observe(s.duration)
+                if "error" in s.attributes:
+                    self._counters["span_errors_total"] += 1
+                if s.attributes.get("aborted"):
+                    self._counters["span_aborted_total"] += 1
+                if "cache_hit" in s.attributes:
+                    key = "cache_hits_total" if s.attributes["cache_hit"] else "cache_misses_total"
+                    self._counters[key] += 1
+                # Only real usage reported by the LLM; estimates stay in the trace attributes
+                for attr in ("prompt_tokens", "completion_tokens"):
+                    if s.attributes.get(attr):
+                        self._counters[f"{attr}_total"] += s.attributes[attr]
+            for name, value in trace.events.items():
+                self._event_hist.setdefault(name, Histogram(self.buckets)).observe(value)
+
+    def _render_histogram(self, lines, metric, hist, labels=""):
+        sep = "," if labels else ""
+        for bound, count in zip(hist.buckets, hist.counts):
+            lines.append(f'{metric}_bucket{{{labels}{sep}le="{bound}"}} {count}')
+        lines.append(f'{metric}_bucket{{{labels}{sep}le="+Inf"}} {hist.total}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{metric}_sum{suffix} {hist.sum:.6f}")
+        lines.append(f"{metric}_count{suffix} {hist.total}")
+
+    def render_prometheus(self):
+        """Render all metrics in the Prometheus text exposition format."""
+        p = self.prefix
+        lines = []
+        with self._lock:
+            lines.append(f"# HELP {p}_request_duration_seconds End-to-end chatbot request latency.")
+            lines.append(f"# TYPE {p}_request_duration_seconds histogram")
+            self._render_histogram(lines, f"{p}_request_duration_seconds", self._request_hist)
+
+            lines.append(f"# HELP {p}_span_duration_seconds Duration of each pipeline stage.")
+            lines.append(f"# TYPE {p}_span_duration_seconds histogram")
+            for name, hist in sorted(self._span_hist.items()):
+                self._render_histogram(lines, f"{p}_span_duration_seconds", hist, f'span="{name}"')
+
+            lines.append(f"# HELP {p}_event_offset_seconds Time from request start to a pipeline event.")
+            lines.append(f"# TYPE {p}_event_offset_seconds histogram")
+            for name, hist in sorted(self._event_hist.items()):
+                self._render_histogram(lines, f"{p}_event_offset_seconds", hist, f'event="{name}"')
+
+            for name, value in sorted(self._counters.items()):
+                lines.append(f"# TYPE {p}_{name} counter")
+                lines.append(f"{p}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class JsonlSink:
+    """Appends one JSON object per finished trace to a file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def write(self, trace):
+        line = json.dumps(trace.to_dict(), ensure_ascii=False, default=str)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+class Tracer:
+    """Creates traces and fans finished ones out to the registry and sinks."""
+
+    def __init__(self, registry=None, sinks=None):
+        self.registry = registry or MetricsRegistry()
+        self.sinks = list(sinks or [])
+
+    def start_trace(self, name, **attributes):
+        return Trace(self, name, attributes)
+
+    def record(self, trace):
+        self.registry.observe_trace(trace)
+        for sink in self.sinks:
+            try:
+                sink.write(trace)
+            except Exception as e:
+                # Tracing must never break a user request
+                print(f"Trace sink error: {e}", file=sys.stderr)
+
+
+def start_metrics_server(registry, port, host="127.0.0.1"):
+    """Serve registry.render_prometheus() on http://host:port/metrics in a daemon thread."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = registry.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Keep scrapes out of the Streamlit log
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    return server
+
+
+class SamplingProfiler:
+    """
+    Periodically samples the stacks of all other threads and counts them.
+
+    Can be started and stopped at runtime; the aggregated samples are kept
+    until reset() so hot paths can be inspected after a slow request. Sampling
+    stops by itself after max_duration seconds, and at most max_keys distinct
+    stacks are tracked (further stacks are counted under "<other>").
+    """
+
+    def __init__(self, interval=0.02, max_depth=12, max_duration=300, max_keys=500):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.max_duration = max_duration
+        self.max_keys = max_keys
+        self.samples = Counter()
+        self.total_samples = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+        self._thread = None
+
+    def reset(self):
+        with self._lock:
+            self.samples.clear()
+            self.total_samples = 0
+
+    def _stack_key(self, frame):
+        # Built from code objects only; avoids linecache source lookups per sample
+        parts = []
+        while frame is not None and len(parts) < self.max_depth:
+            code = frame.f_code
+            parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+            frame = frame.f_back
+        return " <- ".join(parts)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + self.max_duration
+        while not self._stop.wait(self.interval):
+            if time.monotonic() > deadline:
+                break
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, frame in frames.items():
+                    if thread_id == own_id:
+                        continue
+                    key = self._stack_key(frame)
+                    if key not in self.samples and len(self.samples) >= self.max_keys:
+                        key = "<other>"
+                    self.samples[key] += 1
+                    self.total_samples += 1
+
+    def top(self, n=10):
+        """Return the n most frequently sampled stacks as (stack, count) pairs."""
+        with self._lock:
+            return self.samples.most_common(n)